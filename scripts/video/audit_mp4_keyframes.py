@@ -8,36 +8,45 @@ Best-effort MP4 audit without ffprobe:
 - reads stsz sample_count (approx frame count)
 - reads stss sync sample count (keyframes)
 
-Outputs approximate FPS and average keyframe interval.
+Outputs approximate FPS and average keyframe interval, as text (default), JSON or CSV.
 """
 
 from __future__ import annotations
 
 import argparse
+import concurrent.futures
+import csv
+import io
+import json
+import mmap
 import os
+import struct
+import sys
+from dataclasses import dataclass
 from pathlib import Path
 from typing import Iterator, Tuple, Optional
 
 
-def _u32(b: bytes) -> int:
-    return int.from_bytes(b, "big", signed=False)
+_U32 = struct.Struct(">I")
+_U64 = struct.Struct(">Q")
+# size + four-CC; unpacking the type as "4s" yields hashable bytes for any buffer type
+_BOX_HEADER = struct.Struct(">I4s")
+_FOURCC = struct.Struct("4s")
 
 
-def _u64(b: bytes) -> int:
-    return int.from_bytes(b, "big", signed=False)
-
-
-def iter_boxes(buf: bytes, start: int, end: int) -> Iterator[Tuple[str, int, int, int]]:
+def iter_boxes(buf: bytes, start: int, end: int) -> Iterator[Tuple[bytes, int, int, int]]:
+    # local aliases: this loop runs once per box on every traversal
+    unpack_header = _BOX_HEADER.unpack_from
+    unpack_u64 = _U64.unpack_from
     i = start
     while i + 8 <= end:
-        size32 = _u32(buf[i : i + 4])
-        typ = buf[i + 4 : i + 8].decode("ascii", errors="replace")
+        size32, typ = unpack_header(buf, i)
         header = 8
         size = size32
         if size32 == 1:
             if i + 16 > end:
                 break
-            size = _u64(buf[i + 8 : i + 16])
+            size = unpack_u64(buf, i + 8)[0]
             header = 16
         elif size32 == 0:
             size = end - i
@@ -51,194 +60,211 @@ def iter_boxes(buf: bytes, start: int, end: int) -> Iterator[Tuple[str, int, int
         i += size
 
 
-def find_first(buf: bytes, path: list[str]) -> Optional[Tuple[int, int, int]]:
-    """
-    Finds the first occurrence of a nested box path.
-    Returns (start, size, header) or None.
-    """
-
-    def walk(region_start: int, region_end: int, idx: int) -> Optional[Tuple[int, int, int]]:
-        want = path[idx]
-        for typ, start, size, header in iter_boxes(buf, region_start, region_end):
-            if typ != want:
-                continue
-            if idx == len(path) - 1:
-                return (start, size, header)
-            data_start = start + header
-            data_end = start + size
-            # meta has 4-byte version/flags before children
-            if typ == "meta":
-                if data_start + 4 <= data_end:
-                    return walk(data_start + 4, data_end, idx + 1)
-                return None
-            return walk(data_start, data_end, idx + 1)
-        return None
-
-    return walk(0, len(buf), 0)
+# The parse_* helpers read fields at absolute offsets in `buf` rather than slicing out
+# the box payload first: stsz/stss carry per-sample tables that can run to megabytes.
 
 
 def parse_mdhd(buf: bytes, start: int, size: int, header: int) -> tuple[int, int]:
-    data = buf[start + header : start + size]
-    if len(data) < 4:
+    data = start + header
+    avail = size - header
+    if avail < 4:
         raise ValueError("mdhd too small")
-    version = data[0]
+    version = buf[data]
     if version == 1:
         # version(1)/flags(3) + creation(8) + mod(8) + timescale(4) + duration(8)
-        if len(data) < 32:
+        if avail < 32:
             raise ValueError("mdhd v1 too small")
-        timescale = _u32(data[20:24])
-        duration = _u64(data[24:32])
+        timescale = _U32.unpack_from(buf, data + 20)[0]
+        duration = _U64.unpack_from(buf, data + 24)[0]
         return timescale, int(duration)
     # v0: version/flags + creation(4) + mod(4) + timescale(4) + duration(4)
-    if len(data) < 20:
+    if avail < 20:
         raise ValueError("mdhd v0 too small")
-    timescale = _u32(data[12:16])
-    duration = _u32(data[16:20])
+    timescale = _U32.unpack_from(buf, data + 12)[0]
+    duration = _U32.unpack_from(buf, data + 16)[0]
     return timescale, duration
 
 
-def parse_hdlr_handler_type(buf: bytes, start: int, size: int, header: int) -> str:
-    data = buf[start + header : start + size]
+def parse_hdlr_handler_type(buf: bytes, start: int, size: int, header: int) -> bytes:
+    data = start + header
     # version/flags (4) + pre_defined (4) + handler_type (4)
-    if len(data) < 12:
-        return ""
-    return data[8:12].decode("ascii", errors="replace")
+    if size - header < 12:
+        return b""
+    return _FOURCC.unpack_from(buf, data + 8)[0]
 
 
 def parse_stsz_sample_count(buf: bytes, start: int, size: int, header: int) -> int:
-    data = buf[start + header : start + size]
     # version/flags (4) + sample_size (4) + sample_count (4)
-    if len(data) < 12:
+    if size - header < 12:
         return 0
-    return _u32(data[8:12])
+    return _U32.unpack_from(buf, start + header + 8)[0]
 
 
 def parse_stss_sync_count(buf: bytes, start: int, size: int, header: int) -> int:
-    data = buf[start + header : start + size]
     # version/flags (4) + entry_count (4)
-    if len(data) < 8:
+    if size - header < 8:
         return 0
-    return _u32(data[4:8])
+    return _U32.unpack_from(buf, start + header + 4)[0]
 
 
-def locate_video_trak(buf: bytes) -> Optional[Tuple[int, int, int]]:
-    moov = find_first(buf, ["moov"])
-    if not moov:
-        return None
-    moov_start, moov_size, moov_header = moov
-    moov_data_start = moov_start + moov_header
-    moov_data_end = moov_start + moov_size
-
-    for typ, start, size, header in iter_boxes(buf, moov_data_start, moov_data_end):
-        if typ != "trak":
-            continue
-        # handler type lives at trak->mdia->hdlr
-        hdlr = find_first(buf[start : start + size], ["trak", "mdia", "hdlr"])
-        # The above approach doesn't work on sliced buffer; do manual in trak region.
-        trak_data_start = start + header
-        trak_data_end = start + size
-        mdia_box = None
-        for t2, s2, sz2, h2 in iter_boxes(buf, trak_data_start, trak_data_end):
-            if t2 == "mdia":
-                mdia_box = (s2, sz2, h2)
-                break
-        if not mdia_box:
-            continue
-        mdia_start, mdia_size, mdia_header = mdia_box
-        mdia_data_start = mdia_start + mdia_header
-        mdia_data_end = mdia_start + mdia_size
-        hdlr_box = None
-        for t3, s3, sz3, h3 in iter_boxes(buf, mdia_data_start, mdia_data_end):
-            if t3 == "hdlr":
-                hdlr_box = (s3, sz3, h3)
-                break
-        if not hdlr_box:
-            continue
-        handler = parse_hdlr_handler_type(buf, *hdlr_box)
-        if handler == "vide":
-            return (start, size, header)
+@dataclass
+class TrakInfo:
+    """
+    Boxes of interest for one trak, each as (start, size, header).
+    """
+
+    handler: bytes = b""
+    mdhd: Optional[Tuple[int, int, int]] = None
+    stsz: Optional[Tuple[int, int, int]] = None
+    stss: Optional[Tuple[int, int, int]] = None
+
+
+# containers on the path trak->mdia->{hdlr, mdhd, minf->stbl->{stsz, stss}}
+_TRAK_CONTAINERS = frozenset({b"mdia", b"minf", b"stbl"})
+
 
+def find_moov(buf: bytes) -> Optional[Tuple[int, int, int]]:
+    for typ, start, size, header in iter_boxes(buf, 0, len(buf)):
+        if typ == b"moov":
+            return (start, size, header)
     return None
 
 
-def audit_file(path: Path) -> None:
-    buf = path.read_bytes()
-    trak = locate_video_trak(buf)
+def scan_moov(buf: bytes, moov: Tuple[int, int, int]) -> list[TrakInfo]:
+    """
+    Collects a TrakInfo per trak in a single descent of moov.
+    Each nested region is iterated exactly once; nothing outside the trak path is entered.
+    """
+    traks: list[TrakInfo] = []
+
+    def walk(region_start: int, region_end: int, parent: bytes, info: TrakInfo) -> None:
+        for typ, start, size, header in iter_boxes(buf, region_start, region_end):
+            box = (start, size, header)
+            if typ in _TRAK_CONTAINERS:
+                walk(start + header, start + size, typ, info)
+            elif typ == b"hdlr" and parent == b"mdia":
+                # QuickTime files also carry a data-handler hdlr (e.g. 'alis') under minf
+                info.handler = parse_hdlr_handler_type(buf, *box)
+            elif typ == b"mdhd":
+                info.mdhd = box
+            elif typ == b"stsz":
+                info.stsz = box
+            elif typ == b"stss":
+                info.stss = box
+
+    moov_start, moov_size, moov_header = moov
+    for typ, start, size, header in iter_boxes(buf, moov_start + moov_header, moov_start + moov_size):
+        if typ == b"trak":
+            info = TrakInfo()
+            walk(start + header, start + size, typ, info)
+            traks.append(info)
+    return traks
+
+
+RESULT_FIELDS = (
+    "file",
+    "duration_s",
+    "samples",
+    "keyframes",
+    "fps",
+    "avg_keyframe_s",
+    "samples_per_keyframe",
+    "error",
+)
+
+
+def audit_file(path: Path) -> dict:
+    """
+    Returns the audit of `path` as a dict keyed by RESULT_FIELDS.
+    On failure only `file` and `error` are set. That includes unreadable or malformed
+    input, so one bad file can't discard the results of the rest of the batch.
+    Formatting is left to the caller, so parallel runs don't interleave and results
+    can be emitted as text/JSON/CSV.
+    """
+    try:
+        if path.stat().st_size == 0:
+            return {"file": path.name, "error": "empty file"}
+        # Only a few small boxes inside moov are read, so map the file rather than
+        # loading it; untouched mdat pages never leave the disk.
+        with path.open("rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            return _audit_buffer(path, buf)
+    except (OSError, ValueError, struct.error) as exc:
+        return {"file": path.name, "error": str(exc)}
+
+
+def _audit_buffer(path: Path, buf: bytes) -> dict:
+    moov = find_moov(buf)
+    trak = next((t for t in scan_moov(buf, moov) if t.handler == b"vide"), None) if moov else None
     if not trak:
-        print(f"{path.name}: unable to locate video track")
-        return
-
-    trak_start, trak_size, trak_header = trak
-    trak_data_start = trak_start + trak_header
-    trak_data_end = trak_start + trak_size
-
-    # mdhd at trak->mdia->mdhd
-    mdhd_box = None
-    stsz_box = None
-    stss_box = None
-
-    # walk trak->mdia
-    mdia_box = None
-    for typ, start, size, header in iter_boxes(buf, trak_data_start, trak_data_end):
-        if typ == "mdia":
-            mdia_box = (start, size, header)
-            break
-    if not mdia_box:
-        print(f"{path.name}: missing mdia")
-        return
-
-    mdia_start, mdia_size, mdia_header = mdia_box
-    mdia_data_start = mdia_start + mdia_header
-    mdia_data_end = mdia_start + mdia_size
-
-    for typ, start, size, header in iter_boxes(buf, mdia_data_start, mdia_data_end):
-        if typ == "mdhd":
-            mdhd_box = (start, size, header)
-        if typ == "minf":
-            # descend to stbl
-            minf_data_start = start + header
-            minf_data_end = start + size
-            stbl_box = None
-            for t2, s2, sz2, h2 in iter_boxes(buf, minf_data_start, minf_data_end):
-                if t2 == "stbl":
-                    stbl_box = (s2, sz2, h2)
-                    break
-            if stbl_box:
-                stbl_start, stbl_size, stbl_header = stbl_box
-                stbl_data_start = stbl_start + stbl_header
-                stbl_data_end = stbl_start + stbl_size
-                for t3, s3, sz3, h3 in iter_boxes(buf, stbl_data_start, stbl_data_end):
-                    if t3 == "stsz":
-                        stsz_box = (s3, sz3, h3)
-                    if t3 == "stss":
-                        stss_box = (s3, sz3, h3)
-
-    if not mdhd_box or not stsz_box:
-        print(f"{path.name}: missing mdhd/stsz (cannot estimate FPS)")
-        return
-
-    timescale, duration_units = parse_mdhd(buf, *mdhd_box)
+        return {"file": path.name, "error": "unable to locate video track"}
+
+    if not trak.mdhd or not trak.stsz:
+        return {"file": path.name, "error": "missing mdhd/stsz (cannot estimate FPS)"}
+
+    timescale, duration_units = parse_mdhd(buf, *trak.mdhd)
     duration_s = (duration_units / timescale) if timescale else 0.0
-    sample_count = parse_stsz_sample_count(buf, *stsz_box)
-    sync_count = parse_stss_sync_count(buf, *stss_box) if stss_box else 0
+    sample_count = parse_stsz_sample_count(buf, *trak.stsz)
+    sync_count = parse_stss_sync_count(buf, *trak.stss) if trak.stss else 0
 
     fps = (sample_count / duration_s) if duration_s > 0 else 0.0
     avg_keyframe_s = (duration_s / sync_count) if (duration_s > 0 and sync_count > 0) else 0.0
     samples_per_keyframe = (sample_count / sync_count) if sync_count > 0 else 0.0
 
-    print(
-        f"{path.name}: duration={duration_s:.2f}s, samples={sample_count}, keyframes={sync_count}, "
-        f"fps≈{fps:.2f}, avg_keyframe_interval≈{avg_keyframe_s:.2f}s (≈{samples_per_keyframe:.1f} frames)"
+    return {
+        "file": path.name,
+        "duration_s": duration_s,
+        "samples": sample_count,
+        "keyframes": sync_count,
+        "fps": fps,
+        "avg_keyframe_s": avg_keyframe_s,
+        "samples_per_keyframe": samples_per_keyframe,
+    }
+
+
+def format_text(result: dict) -> str:
+    if result.get("error"):
+        return f"{result['file']}: {result['error']}"
+    return (
+        f"{result['file']}: duration={result['duration_s']:.2f}s, samples={result['samples']}, "
+        f"keyframes={result['keyframes']}, fps≈{result['fps']:.2f}, "
+        f"avg_keyframe_interval≈{result['avg_keyframe_s']:.2f}s (≈{result['samples_per_keyframe']:.1f} frames)"
     )
 
 
+def render(results: list[dict], fmt: str) -> str:
+    if fmt == "json":
+        return json.dumps(results, indent=2) + "\n"
+    if fmt == "csv":
+        out = io.StringIO()
+        writer = csv.DictWriter(out, fieldnames=RESULT_FIELDS, lineterminator="\n")
+        writer.writeheader()
+        writer.writerows(results)
+        return out.getvalue()
+    return "".join(format_text(r) + "\n" for r in results)
+
+
 def main(argv) -> int:
     ap = argparse.ArgumentParser()
     ap.add_argument("files", nargs="+", help="MP4 files to audit")
+    ap.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="audit files in N worker processes (default: 1; worth it only for many large files)",
+    )
+    ap.add_argument("--format", choices=("text", "json", "csv"), default="text", help="output format")
     args = ap.parse_args(argv)
-    for f in args.files:
-        audit_file(Path(f))
-    return 0
+    files = [Path(f) for f in args.files]
+    jobs = max(1, min(args.jobs, len(files)))
+    if jobs == 1:
+        results = [audit_file(f) for f in files]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as ex:
+            results = list(ex.map(audit_file, files))
+    # one write for the whole batch instead of a print (and flush) per file
+    sys.stdout.write(render(results, args.format))
+    return 1 if any(r.get("error") for r in results) else 0
 
 
 if __name__ == "__main__":
@@ -4,6 +4,7 @@ faststart_mp4.py
 
 Moves the `moov` atom to the front of an MP4 ("fast start") and adjusts chunk offsets.
 This is similar to `qtfaststart`, but implemented in pure Python.
+If NumPy is installed, chunk offset tables are rewritten with vectorized adds.
 
 Usage:
   python3 scripts/video/faststart_mp4.py public/assets/hero/h_h_1.mp4
@@ -13,55 +14,51 @@ Usage:
 from __future__ import annotations
 
 import argparse
+import concurrent.futures
+import functools
+import mmap
 import os
+import struct
 from pathlib import Path
-from typing import Iterable, Iterator, Tuple
+from typing import BinaryIO, Iterable, Iterator, Optional, Tuple
 
+try:
+    import numpy as np
+except ImportError:  # optional: falls back to the per-entry loop
+    np = None
 
-ContainerBoxes = {
-    "moov",
-    "trak",
-    "mdia",
-    "minf",
-    "stbl",
-    "edts",
-    "dinf",
-    "udta",
-    "meta",  # has 4-byte version/flags header before children
-    "ilst",
-}
 
+# stco/co64 only ever live at moov/trak/mdia/minf/stbl, so the offset walk descends
+# through these alone and skips udta/meta/edts/dinf subtrees (cover art, metadata).
+_OFFSET_PATH_CONTAINERS: frozenset[bytes] = frozenset({b"moov", b"trak", b"mdia", b"minf", b"stbl"})
 
-def _u32(b: bytes) -> int:
-    return int.from_bytes(b, "big", signed=False)
 
+_U32 = struct.Struct(">I")
+_U64 = struct.Struct(">Q")
+# size + four-CC; unpacking the type as "4s" yields hashable bytes for any buffer type
+_BOX_HEADER = struct.Struct(">I4s")
 
-def _u64(b: bytes) -> int:
-    return int.from_bytes(b, "big", signed=False)
+_COPY_CHUNK = 4 * 1024 * 1024
+_COPY_THREADS = 4
 
 
-def _p32(v: int) -> bytes:
-    return int(v).to_bytes(4, "big", signed=False)
-
-
-def _p64(v: int) -> bytes:
-    return int(v).to_bytes(8, "big", signed=False)
-
-
-def iter_boxes(buf: bytes, start: int, end: int) -> Iterator[Tuple[str, int, int, int]]:
+def iter_boxes(buf: bytes, start: int, end: int) -> Iterator[Tuple[bytes, int, int, int]]:
     """
     Yields (type, box_start, box_size, header_size) for immediate child boxes in [start, end).
+    `type` is the raw four-CC as bytes (e.g. b"moov"); decode only when printing.
     """
+    # local aliases: this loop runs once per box on every traversal
+    unpack_header = _BOX_HEADER.unpack_from
+    unpack_u64 = _U64.unpack_from
     i = start
     while i + 8 <= end:
-        size32 = _u32(buf[i : i + 4])
-        typ = buf[i + 4 : i + 8].decode("ascii", errors="replace")
+        size32, typ = unpack_header(buf, i)
         header = 8
         size = size32
         if size32 == 1:
             if i + 16 > end:
                 break
-            size = _u64(buf[i + 8 : i + 16])
+            size = unpack_u64(buf, i + 8)[0]
             header = 16
         elif size32 == 0:
             size = end - i
@@ -75,119 +72,303 @@ def iter_boxes(buf: bytes, start: int, end: int) -> Iterator[Tuple[str, int, int
         i += size
 
 
-def find_top_level_atoms(buf: bytes) -> dict[str, Tuple[int, int, int]]:
+def find_needed_atoms(buf: bytes) -> dict[bytes, Tuple[int, int, int]]:
     """
-    Returns mapping: type -> (start, size, header_size) for top-level boxes.
-    If multiple boxes of same type exist, the last one wins (fine for our use).
+    Returns mapping: type -> (start, size, header_size) for the top-level ftyp, moov and mdat.
+    The first box of each type wins, and the walk stops as soon as all three are found,
+    so an mdat after moov is not reported here; process_file checks for that separately.
     """
-    out: dict[str, Tuple[int, int, int]] = {}
+    pending = {b"ftyp", b"moov", b"mdat"}
+    out: dict[bytes, Tuple[int, int, int]] = {}
     for typ, start, size, header in iter_boxes(buf, 0, len(buf)):
-        out[typ] = (start, size, header)
+        if typ in pending:
+            out[typ] = (start, size, header)
+            pending.discard(typ)
+            if not pending:
+                break
     return out
 
 
+def _add_offsets_np(mv: memoryview, table_start: int, entry_count: int, dtype: str, delta: int) -> None:
+    """
+    Adds `delta` to a big-endian offset table in one vectorized pass.
+    The table is a writable view into `mv`, so the add happens in place: NumPy byteswaps
+    through its ufunc buffers and runs the add as a SIMD loop, with no Python-level copies.
+    """
+    if entry_count == 0:
+        return
+    table = np.frombuffer(mv, dtype=dtype, count=entry_count, offset=table_start)
+    if int(table.min()) + delta < 0 or int(table.max()) + delta > np.iinfo(table.dtype).max:
+        raise OverflowError(f"chunk offset {delta:+d} does not fit in {dtype}")
+    # uint wraparound makes a negative delta come out right once the range check passed
+    table += np.array(delta).astype(table.dtype)
+
+
+def _add_offsets_u32_swar(mv: memoryview, table_start: int, entry_count: int, delta: int) -> None:
+    """
+    Pure-Python stco fallback: updates two big-endian 32-bit offsets per 64-bit unpack/pack.
+    Adding (delta << 32) + delta to the pair adds delta to both lanes as long as neither
+    leaves [0, 2**32), and a lane that does is an overflow anyway: the low lane is checked
+    explicitly, the high lane pushes the sum outside u64 and makes pack_into fail.
+    """
+    addend = (delta << 32) + delta
+    # the low lane is in range iff its old value lies in [lo, hi]
+    lo = max(0, -delta)
+    hi = 0xFFFFFFFF - max(0, delta)
+    unpack = _U64.unpack_from
+    pack = _U64.pack_into
+    pairs_end = table_start + (entry_count & ~1) * 4
+    try:
+        for off in range(table_start, pairs_end, 8):
+            pair = unpack(mv, off)[0]
+            if not lo <= (pair & 0xFFFFFFFF) <= hi:
+                raise struct.error("low lane out of range")
+            pack(mv, off, pair + addend)
+        if entry_count & 1:
+            _U32.pack_into(mv, pairs_end, _U32.unpack_from(mv, pairs_end)[0] + delta)
+    except struct.error as exc:
+        raise OverflowError(f"chunk offset {delta:+d} does not fit in >u4") from exc
+
+
+def _add_offsets_u64(mv: memoryview, table_start: int, entry_count: int, delta: int) -> None:
+    """
+    Pure-Python co64 fallback: one unpack_from/pack_into per entry, in place in `mv`.
+    """
+    unpack = _U64.unpack_from
+    pack = _U64.pack_into
+    try:
+        for off in range(table_start, table_start + entry_count * 8, 8):
+            pack(mv, off, unpack(mv, off)[0] + delta)
+    except struct.error as exc:
+        raise OverflowError(f"chunk offset {delta:+d} does not fit in >u8") from exc
+
+
 def adjust_chunk_offsets(moov: bytearray, delta: int) -> None:
     """
     Adjusts chunk offsets in `stco` (32-bit) and `co64` (64-bit) boxes inside moov by +delta.
+    Works through one memoryview of `moov`, so reads and writes go straight to the
+    bytearray with no intermediate bytes objects.
     """
+    with memoryview(moov) as mv:
+        _adjust_chunk_offsets(mv, delta)
 
-    def recurse(region_start: int, region_end: int, parent_type: str) -> None:
-        for typ, start, size, header in iter_boxes(moov, region_start, region_end):
+
+def _adjust_chunk_offsets(mv: memoryview, delta: int) -> None:
+    offset_path = _OFFSET_PATH_CONTAINERS
+
+    def recurse(region_start: int, region_end: int) -> None:
+        for typ, start, size, header in iter_boxes(mv, region_start, region_end):
             data_start = start + header
             data_end = start + size
 
-            if typ in ContainerBoxes:
-                if typ == "meta":
-                    # meta begins with 4 bytes version/flags then children boxes
-                    if data_start + 4 <= data_end:
-                        recurse(data_start + 4, data_end, typ)
-                else:
-                    recurse(data_start, data_end, typ)
+            if typ in offset_path:
+                recurse(data_start, data_end)
                 continue
 
-            if typ == "stco":
+            if typ == b"stco":
                 # version/flags (4) + entry_count (4) ...
                 if data_start + 8 > data_end:
                     continue
-                entry_count = _u32(moov[data_start + 4 : data_start + 8])
+                entry_count = _U32.unpack_from(mv, data_start + 4)[0]
                 table_start = data_start + 8
                 table_bytes = entry_count * 4
                 if table_start + table_bytes > data_end:
                     continue
-                for i in range(entry_count):
-                    off = table_start + i * 4
-                    val = _u32(moov[off : off + 4])
-                    moov[off : off + 4] = _p32(val + delta)
+                if np is not None:
+                    _add_offsets_np(mv, table_start, entry_count, ">u4", delta)
+                    continue
+                _add_offsets_u32_swar(mv, table_start, entry_count, delta)
                 continue
 
-            if typ == "co64":
+            if typ == b"co64":
                 if data_start + 8 > data_end:
                     continue
-                entry_count = _u32(moov[data_start + 4 : data_start + 8])
+                entry_count = _U32.unpack_from(mv, data_start + 4)[0]
                 table_start = data_start + 8
                 table_bytes = entry_count * 8
                 if table_start + table_bytes > data_end:
                     continue
-                for i in range(entry_count):
-                    off = table_start + i * 8
-                    val = _u64(moov[off : off + 8])
-                    moov[off : off + 8] = _p64(val + delta)
+                if np is not None:
+                    _add_offsets_np(mv, table_start, entry_count, ">u8", delta)
+                    continue
+                _add_offsets_u64(mv, table_start, entry_count, delta)
                 continue
 
-    recurse(0, len(moov), "moov")
+    recurse(0, len(mv))
 
 
-def moov_is_faststart(buf: bytes, moov_start: int, mdat_start: int) -> bool:
-    return moov_start >= 0 and (mdat_start < 0 or moov_start < mdat_start)
+def _pwrite_all(fd: int, buf: memoryview, offset: int) -> None:
+    while buf:
+        n = os.pwrite(fd, buf, offset)
+        buf = buf[n:]
+        offset += n
 
 
-def process_file(path: Path) -> None:
-    data = path.read_bytes()
-    atoms = find_top_level_atoms(data)
+def _copy_chunk(src_fd: int, dst_fd: int, mv: memoryview, src: int, dst: int, length: int) -> None:
+    """
+    Copies `length` bytes from input offset `src` to output offset `dst`.
+    Both sides are positional, so chunks can be copied concurrently in any order.
+    """
+    if hasattr(os, "copy_file_range"):
+        try:
+            while length > 0:
+                n = os.copy_file_range(src_fd, dst_fd, length, src, dst)
+                if n == 0:
+                    raise RuntimeError("unexpected end of input while copying")
+                src += n
+                dst += n
+                length -= n
+            return
+        except OSError:
+            # e.g. ENOSYS/EXDEV on older kernels: finish the remainder from the mapping
+            pass
+    _pwrite_all(dst_fd, mv[src : src + length], dst)
+
+
+def _copy_ranges(
+    src: BinaryIO,
+    data: mmap.mmap,
+    out: BinaryIO,
+    ranges: list[Tuple[int, int, int]],
+    copier: Optional[concurrent.futures.Executor] = None,
+) -> None:
+    """
+    Copies each (src_start, src_end, dst_start) range of the input into `out`.
+    Ranges are split into 4 MiB chunks and copied by a few threads, so reads of one
+    chunk overlap writes of another instead of the pipeline stalling on each syscall.
+    Pass `copier` to share one bounded pool across files; otherwise a private one is used.
+    """
+    if copier is None:
+        with concurrent.futures.ThreadPoolExecutor(_COPY_THREADS) as own:
+            _copy_ranges(src, data, out, ranges, own)
+        return
 
-    if "moov" not in atoms or "ftyp" not in atoms:
-        raise RuntimeError(f"{path}: missing required top-level atoms (need ftyp + moov)")
+    chunks = [
+        (off, dst_start + (off - src_start), min(_COPY_CHUNK, src_end - off))
+        for src_start, src_end, dst_start in ranges
+        for off in range(src_start, src_end, _COPY_CHUNK)
+    ]
+    with memoryview(data) as mv:
+        futures = [copier.submit(_copy_chunk, src.fileno(), out.fileno(), mv, *chunk) for chunk in chunks]
+        # a shared pool outlives this call: every chunk must finish before mv is released
+        concurrent.futures.wait(futures)
+        for fut in futures:
+            fut.result()
 
-    moov_start, moov_size, _ = atoms["moov"]
-    ftyp_start, ftyp_size, _ = atoms["ftyp"]
-    mdat_start, _, _ = atoms.get("mdat", (-1, -1, -1))
 
-    if moov_is_faststart(data, moov_start, mdat_start):
-        print(f"{path}: already faststart (moov before mdat)")
+def _fadvise(fd: int, advice: str) -> None:
+    """
+    Best-effort posix_fadvise over the whole file; a no-op where unsupported (e.g. macOS).
+    """
+    if not hasattr(os, "posix_fadvise") or not hasattr(os, advice):
         return
-
-    if ftyp_start != 0:
-        # uncommon, but we can still insert after ftyp box (wherever it is).
+    try:
+        os.posix_fadvise(fd, 0, 0, getattr(os, advice))
+    except OSError:
         pass
 
-    insert_at = ftyp_start + ftyp_size
-    if insert_at <= 0 or insert_at > len(data):
-        raise RuntimeError(f"{path}: invalid ftyp size; cannot determine insert point")
 
-    if moov_start < insert_at:
-        raise RuntimeError(f"{path}: unexpected layout (moov before insert point but after mdat?)")
+def _madvise(data: mmap.mmap, advice: str) -> None:
+    """
+    Best-effort madvise over the whole mapping; a no-op where unsupported.
+    """
+    if not hasattr(mmap, advice):
+        return
+    try:
+        data.madvise(getattr(mmap, advice))
+    except OSError:
+        pass
 
-    moov_bytes = bytearray(data[moov_start : moov_start + moov_size])
-    delta = moov_size
-    adjust_chunk_offsets(moov_bytes, delta=delta)
 
-    out_path = path.with_suffix(path.suffix + ".faststart")
-    # New layout: [prefix up to insert_at] + [moov (adjusted)] + [rest excluding moov]
-    rebuilt = (
-        data[:insert_at]
-        + bytes(moov_bytes)
-        + data[insert_at:moov_start]
-        + data[moov_start + moov_size :]
-    )
+def moov_is_faststart(buf: bytes, moov_start: int, mdat_start: int) -> bool:
+    return moov_start >= 0 and (mdat_start < 0 or moov_start < mdat_start)
 
-    out_path.write_bytes(rebuilt)
 
-    # quick verification: moov should now appear early
-    check = out_path.read_bytes()
-    check_atoms = find_top_level_atoms(check)
-    new_moov_start, _, _ = check_atoms["moov"]
-    new_mdat_start, _, _ = check_atoms.get("mdat", (-1, -1, -1))
-    print(
+def process_file(path: Path, copier: Optional[concurrent.futures.Executor] = None) -> str:
+    """
+    Writes `<path>.faststart` if needed and returns a one-line status message.
+    `copier` is the thread pool for the data copy; see _copy_ranges.
+    """
+    if path.stat().st_size == 0:
+        raise RuntimeError(f"{path}: empty file")
+
+    # Map the input instead of reading it: only box headers, moov and the copied
+    # ranges are ever touched, so the OS pages in just what we need.
+    with path.open("rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        atoms = find_needed_atoms(data)
+
+        if b"moov" not in atoms or b"ftyp" not in atoms:
+            raise RuntimeError(f"{path}: missing required top-level atoms (need ftyp + moov)")
+
+        moov_start, moov_size, _ = atoms[b"moov"]
+        ftyp_start, ftyp_size, _ = atoms[b"ftyp"]
+        mdat_start, _, _ = atoms.get(b"mdat", (-1, -1, -1))
+
+        if moov_is_faststart(data, moov_start, mdat_start):
+            return f"{path}: already faststart (moov before mdat)"
+
+        if ftyp_start != 0:
+            # uncommon, but we can still insert after ftyp box (wherever it is).
+            pass
+
+        insert_at = ftyp_start + ftyp_size
+        if insert_at <= 0 or insert_at > len(data):
+            raise RuntimeError(f"{path}: invalid ftyp size; cannot determine insert point")
+
+        if moov_start < insert_at:
+            raise RuntimeError(f"{path}: unexpected layout (moov before insert point but after mdat?)")
+
+        # Moving moov only shifts [insert_at, moov_start), but adjust_chunk_offsets adds delta to
+        # every chunk offset. Chunks in an mdat after moov would end up pointing past their data.
+        moov_end = moov_start + moov_size
+        if any(typ == b"mdat" for typ, _, _, _ in iter_boxes(data, moov_end, len(data))):
+            raise RuntimeError(f"{path}: unsupported layout (mdat both before and after moov)")
+
+        # slicing the mmap would build a bytes copy only to copy it again into the bytearray
+        with memoryview(data) as view:
+            moov_bytes = bytearray(view[moov_start : moov_start + moov_size])
+        delta = moov_size
+        adjust_chunk_offsets(moov_bytes, delta=delta)
+
+        out_path = path.with_suffix(path.suffix + ".faststart")
+        # New layout: [prefix up to insert_at] + [moov (adjusted)] + [rest excluding moov]
+        # From here on each input byte is read once, in ascending 4 MiB chunks with a few in
+        # flight at a time: close enough to sequential for read-ahead to pay off.
+        _fadvise(f.fileno(), "POSIX_FADV_SEQUENTIAL")
+        _madvise(data, "MADV_SEQUENTIAL")
+        with out_path.open("wb") as out:
+            _fadvise(out.fileno(), "POSIX_FADV_SEQUENTIAL")
+            out.truncate(len(data))
+            with memoryview(moov_bytes) as mv:
+                _pwrite_all(out.fileno(), mv, insert_at)
+            _copy_ranges(
+                f,
+                data,
+                out,
+                [
+                    (0, insert_at, 0),
+                    (insert_at, moov_start, insert_at + moov_size),
+                    (moov_end, len(data), moov_end),
+                ],
+                copier,
+            )
+        # The input won't be read again: let the kernel drop its pages rather than
+        # evicting hotter cache to keep a multi-GB video around.
+        _fadvise(f.fileno(), "POSIX_FADV_DONTNEED")
+
+    # The new layout follows from the input, so there is no need to re-read the output:
+    # moov lands at insert_at and anything between insert_at and the old moov shifts by moov_size.
+    new_moov_start = insert_at
+    new_mdat_start = mdat_start
+    if insert_at <= mdat_start < moov_start:
+        new_mdat_start += moov_size
+
+    # quick verification: the moov header should be where we put it
+    with out_path.open("rb") as check:
+        check.seek(new_moov_start + 4)
+        if check.read(4) != b"moov":
+            raise RuntimeError(f"{out_path}: moov not found at offset {new_moov_start} after rewrite")
+    return (
         f"{path.name}: wrote {out_path.name} | old moov@{moov_start} -> new moov@{new_moov_start} | mdat@{new_mdat_start}"
     )
 
@@ -195,13 +376,30 @@ def process_file(path: Path) -> None:
 def main(argv: Iterable[str]) -> int:
     parser = argparse.ArgumentParser()
     parser.add_argument("files", nargs="+", help="MP4 files to faststart")
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=None,
+        help="files to process concurrently (default: one per file, up to CPU count)",
+    )
     args = parser.parse_args(list(argv))
 
-    for f in args.files:
-        p = Path(f)
+    paths = [Path(f) for f in args.files]
+    for p in paths:
         if not p.exists():
             raise FileNotFoundError(f"{p} not found")
-        process_file(p)
+
+    # Each file writes its own .faststart output, so they are independent. The work is
+    # mostly copy_file_range/pwrite syscalls that release the GIL, so threads are enough.
+    jobs = args.jobs or min(os.cpu_count() or 1, len(paths))
+    jobs = max(1, min(jobs, len(paths)))
+    # One copy pool shared by all files bounds concurrent copy syscalls against the disk
+    # to _COPY_THREADS, however many files run at once.
+    with concurrent.futures.ThreadPoolExecutor(_COPY_THREADS) as copier:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as ex:
+            for line in ex.map(functools.partial(process_file, copier=copier), paths):
+                print(line)
     return 0
 
 